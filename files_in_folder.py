@@ -14,13 +14,33 @@ import shutil # File copy operations
 
 import hashlib # Hashing functions
 import json # JSON stuff
+import csv # Streaming CSV reading
 
+import tarfile # Tar archive reading
+import zipfile # Zip archive reading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED # Parallel hashing and copying
 
+
+import time # Archive member timestamps
 from time import localtime as clock # Time a function
 
 # Filenames we don't want to check:
 PROTECTED_FILENAMES = ['contents.csv', 'missing.txt']
 
+# Archive extensions we know how to hash member-by-member:
+ARCHIVE_EXTENSIONS = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+
+# Block size used when repairing files in place with delta repair:
+DELTA_BLOCKSIZE = 1048576
+
+# Tree hashing: large files are split into fixed chunks, hashed in parallel and combined into a root digest.
+# Tree digests are written as "tree<version>-<algorithm>-<chunk size>:<root digest>" so they can never be
+# mistaken for (or match) a plain md5/sha digest.
+TREE_HASH_VERSION = 1
+TREE_CHUNKSIZE = 67108864
+# Chunk digests are kept between runs (cleanup() leaves them alone), under a name unlikely to clash with user files:
+CHUNKS_FILENAME = '.files_in_folder.chunks.json'
+
 class FilesInFolder:
     def __init__(
                     self,
@@ -32,6 +52,11 @@ class FilesInFolder:
                     contents_filename='contents.json',
                     missing_files_filename='missing.txt',
                     fix_missing_files=False,
+                    hash_archives=False,
+                    max_workers=None,
+                    repair_mode='copy',
+                    tree_hash_threshold=None,
+                    tree_chunk_size=TREE_CHUNKSIZE,
                     verbose=False
                 ):
 
@@ -45,6 +70,13 @@ class FilesInFolder:
         self.contents_filename = contents_filename
         self.missing_files_filename = missing_files_filename
         self.fix_missing_files = fix_missing_files
+        self.hash_archives = hash_archives
+        self.max_workers = max_workers
+        self.repair_mode = repair_mode
+        self.tree_hash_threshold = tree_hash_threshold
+        self.tree_chunk_size = tree_chunk_size
+        self.chunk_digests = {} # filepath: {'digest': ..., 'hash_algorithm': ..., 'chunk_size': ..., 'size': ..., 'mtime_ns': ..., 'chunks': [...]}
+        self.archive_members = {} # reported member filepath: (archive_filepath, member_name)
 
         try:
             # If valid directories have not been provided:
@@ -106,6 +138,199 @@ class FilesInFolder:
 
         return hash_value
 
+    def hash_file_chunk(self, filepath=None, offset=0, chunk_size=TREE_CHUNKSIZE, hash_algorithm='md5'):
+        '''
+        Uses given hashing algorithm to hash one fixed-size chunk of a file, starting at the given offset.
+        Each call opens its own handle so several chunks of the same file can be hashed at once.
+        '''
+        BLOCKSIZE = 1048576
+        h = hashlib.new(hash_algorithm)
+        with open(filepath, 'rb') as inFile:
+            inFile.seek(offset)
+            remaining = chunk_size
+            buf = inFile.read(min(BLOCKSIZE, remaining))
+            while len(buf) > 0:
+                h.update(buf)
+                remaining -= len(buf)
+                buf = inFile.read(min(BLOCKSIZE, remaining))
+        return h.hexdigest()
+
+    def combine_chunk_digests(self, chunks=[], hash_algorithm='md5', chunk_size=TREE_CHUNKSIZE):
+        '''
+        Combines a list of chunk digests into a versioned tree digest.
+        '''
+        h = hashlib.new(hash_algorithm)
+        for chunk in chunks:
+            h.update(bytes.fromhex(chunk))
+        return 'tree{version}-{hash_algorithm}-{chunk_size}:{root}'.format(
+                                                                            version=TREE_HASH_VERSION,
+                                                                            hash_algorithm=hash_algorithm,
+                                                                            chunk_size=chunk_size,
+                                                                            root=h.hexdigest()
+                                                                        )
+
+    def hash_stream_tree(self, inFile=None, hash_algorithm='md5', chunk_size=TREE_CHUNKSIZE):
+        '''
+        Tree hashes a readable stream that cannot be split up front (such as an archive member), one chunk
+        after the other. Gives the same digest hash_file_tree gives for the same bytes.
+        '''
+        BLOCKSIZE = 1048576
+        chunks = []
+        buf = inFile.read(min(BLOCKSIZE, chunk_size))
+        while len(buf) > 0:
+            h = hashlib.new(hash_algorithm)
+            remaining = chunk_size
+            while len(buf) > 0:
+                h.update(buf)
+                remaining -= len(buf)
+                if remaining == 0:
+                    break
+                buf = inFile.read(min(BLOCKSIZE, remaining))
+            chunks.append(h.hexdigest())
+            buf = inFile.read(min(BLOCKSIZE, chunk_size))
+        if chunks == []:
+            # An empty file still has one (empty) chunk:
+            chunks.append(hashlib.new(hash_algorithm).hexdigest())
+        return self.combine_chunk_digests(chunks=chunks, hash_algorithm=hash_algorithm, chunk_size=chunk_size)
+
+    def hash_file_tree(self, filepath=None, hash_algorithm='md5', chunk_size=TREE_CHUNKSIZE):
+        '''
+        Splits the file into fixed-size chunks, hashes the chunks in parallel and combines the chunk digests
+        into a versioned root digest. The chunk digests are kept in self.chunk_digests for later reuse.
+        '''
+        hash_value = 0x666
+        try:
+            if filepath == None or not os.path.exists(filepath):
+                raise IOError('[ERROR] Please provide a valid filepath to hash.')
+
+            file_stat = os.stat(filepath)
+            digest_prefix = 'tree{version}-{hash_algorithm}-{chunk_size}:'.format(version=TREE_HASH_VERSION, hash_algorithm=hash_algorithm, chunk_size=chunk_size)
+
+            # Reuse stored chunk digests (e.g. loaded from an earlier run) while the file is unchanged:
+            stored_entry = self.chunk_digests.get(str(filepath))
+            if stored_entry != None and stored_entry.get('hash_algorithm') == hash_algorithm and stored_entry['digest'].startswith(digest_prefix) \
+                and stored_entry.get('size') == file_stat.st_size and stored_entry.get('mtime_ns') == file_stat.st_mtime_ns:
+                return stored_entry['digest']
+
+            if self.verbose:
+                print('[{action_counter}] Tree hashing file contents of {filepath}.\n'.format(action_counter=self.action_counter, filepath=filepath))
+
+            offsets = range(0, max(file_stat.st_size, 1), chunk_size)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                chunks = list(executor.map(
+                    lambda offset: self.hash_file_chunk(filepath=filepath, offset=offset, chunk_size=chunk_size, hash_algorithm=hash_algorithm),
+                    offsets
+                ))
+
+            hash_value = self.combine_chunk_digests(chunks=chunks, hash_algorithm=hash_algorithm, chunk_size=chunk_size)
+            self.chunk_digests[str(filepath)] = {
+                                                    'digest': hash_value,
+                                                    'hash_algorithm': hash_algorithm,
+                                                    'chunk_size': chunk_size,
+                                                    'size': file_stat.st_size,
+                                                    'mtime_ns': file_stat.st_mtime_ns,
+                                                    'chunks': chunks
+                                                }
+        except Exception as e:
+            print(e)
+
+        return hash_value
+
+    def load_chunk_digests(self, chunks_filepath=None):
+        '''
+        Loads chunk digests previously written by write_chunk_digests into self.chunk_digests.
+        '''
+        try:
+            if chunks_filepath == None or not os.path.exists(chunks_filepath):
+                raise IOError('[ERROR] Please provide a valid chunk digests file to load.')
+            with open(chunks_filepath, 'r') as infile:
+                self.chunk_digests.update(json.load(infile))
+        except Exception as e:
+            print(e)
+
+    def write_chunk_digests(self, directory=None, chunks_filepath=None):
+        '''
+        Writes the stored chunk digests of every tree-hashed file in the given directory to a JSON file.
+        '''
+        try:
+            if directory == None or chunks_filepath == None:
+                raise Exception('[ERROR] Need to provide a directory and a file to write chunk digests.')
+            directory_chunk_digests = {
+                filepath: entry for filepath, entry in self.chunk_digests.items()
+                if os.path.normpath(os.path.dirname(filepath)) == os.path.normpath(directory) and os.path.isfile(filepath)
+            }
+            if directory_chunk_digests != {}:
+                with open(chunks_filepath, 'w') as outfile:
+                    json.dump(directory_chunk_digests, outfile)
+        except Exception as e:
+            print(e)
+
+    def verify_file_chunks(self, filepath=None, chunk_indices=None):
+        '''
+        Re-hashes the given chunks (or all chunks) of a tree-hashed file and returns the indices
+        of the chunks that no longer match their stored digests. If the file has grown or shrunk,
+        the chunks it gained or lost are reported too.
+        '''
+        mismatched_chunks = []
+        try:
+            if str(filepath) not in self.chunk_digests:
+                raise Exception('[ERROR] No chunk digests stored for {filepath}.'.format(filepath=filepath))
+            entry = self.chunk_digests[str(filepath)]
+            hash_algorithm = entry['hash_algorithm']
+            chunk_size = entry['chunk_size']
+            stored_count = len(entry['chunks'])
+            file_size = os.path.getsize(filepath)
+            current_count = -(-max(file_size, 1) // chunk_size)
+            common_count = min(stored_count, current_count)
+
+            if chunk_indices == None:
+                chunk_indices = range(stored_count)
+            chunk_indices = {index for index in chunk_indices if index < common_count}
+            # A size change always touches the last chunk both versions share:
+            if file_size != entry.get('size', stored_count * chunk_size) and common_count > 0:
+                chunk_indices.add(common_count - 1)
+            chunk_indices = sorted(chunk_indices)
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                chunks = executor.map(
+                    lambda index: self.hash_file_chunk(filepath=filepath, offset=index * chunk_size, chunk_size=chunk_size, hash_algorithm=hash_algorithm),
+                    chunk_indices
+                )
+                for index, chunk in zip(chunk_indices, chunks):
+                    if chunk != entry['chunks'][index]:
+                        mismatched_chunks.append(index)
+
+            # Chunks appended to, or cut from, the end of the file:
+            mismatched_chunks.extend(range(common_count, max(stored_count, current_count)))
+        except Exception as e:
+            print(e)
+
+        return mismatched_chunks
+
+    def compare_chunk_digests(self, left_filepath=None, right_filepath=None):
+        '''
+        Given two tree-hashed files, returns the indices of the chunks that differ between them,
+        without reading either file again. Returns None if the files were tree hashed differently
+        or either file changed since it was hashed.
+        '''
+        left_entry = self.chunk_digests.get(str(left_filepath))
+        right_entry = self.chunk_digests.get(str(right_filepath))
+        if left_entry == None or right_entry == None:
+            return None
+        if left_entry['digest'].split(':')[0] != right_entry['digest'].split(':')[0]:
+            return None
+        # Digests of a file that changed since it was hashed can't be trusted:
+        for filepath, entry in ((left_filepath, left_entry), (right_filepath, right_entry)):
+            file_stat = os.stat(filepath)
+            if file_stat.st_size != entry.get('size') or file_stat.st_mtime_ns != entry.get('mtime_ns'):
+                return None
+        left_chunks = left_entry['chunks']
+        right_chunks = right_entry['chunks']
+        return [
+            index for index in range(max(len(left_chunks), len(right_chunks)))
+            if index >= len(left_chunks) or index >= len(right_chunks) or left_chunks[index] != right_chunks[index]
+        ]
+
     def hash_filename(self, filename=None, hash_algorithm='md5'):
         '''
         Uses given hashing algorithm to hash the given filename.
@@ -124,6 +349,133 @@ class FilesInFolder:
             print(e)
         return hash_value
 
+    def is_archive(self, filepath=None):
+        '''
+        Returns True if the given filepath looks like an archive we can hash member-by-member.
+        '''
+        lowered = str(filepath).lower()
+        return any(lowered.endswith(extension) for extension in ARCHIVE_EXTENSIONS)
+
+    def is_safe_member_name(self, member_name=None):
+        '''
+        Returns False for archive member names that are absolute or climb out of the archive with "..".
+        '''
+        normalized_name = str(member_name).replace('\\', '/')
+        return not normalized_name.startswith('/') and not os.path.isabs(normalized_name) and '..' not in normalized_name.split('/')
+
+    def add_archive_member(self, archive_filepath=None, member_name=None):
+        '''
+        Returns the filepath an archive member is reported under (<archive_filepath>/<member_name>)
+        and remembers which (archive_filepath, member_name) pair it came from.
+        '''
+        member_filepath = archive_filepath + '/' + member_name
+        self.archive_members[member_filepath] = (archive_filepath, member_name)
+        return member_filepath
+
+    def is_tree_hashed(self, size=0):
+        '''
+        Returns True if contents of the given size are tree hashed rather than hashed in one stream.
+        '''
+        return self.tree_hash_threshold != None and size >= self.tree_hash_threshold
+
+    def hash_archive_member(self, archive=None, member_name=None, hash_algorithm='md5'):
+        '''
+        Uses given hashing algorithm to hash a single member of an open zip archive.
+        An open ZipFile may be shared between threads; every member gets its own read handle.
+        Members over the tree hash threshold get the same tree digest a plain file would.
+        '''
+        BLOCKSIZE = 65536
+        hash_value = 0x666
+        try:
+            if self.is_tree_hashed(size=archive.getinfo(member_name).file_size):
+                with archive.open(member_name) as inFile:
+                    return self.hash_stream_tree(inFile=inFile, hash_algorithm=hash_algorithm, chunk_size=self.tree_chunk_size)
+            with archive.open(member_name) as inFile:
+                h = hashlib.new(hash_algorithm)
+                buf = inFile.read(BLOCKSIZE)
+                while len(buf) > 0:
+                    h.update(buf)
+                    buf = inFile.read(BLOCKSIZE)
+            hash_value = h.hexdigest()
+        except Exception as e:
+            print(e)
+
+        return hash_value
+
+    def get_archive_hashes(self, archive_filepath=None, hash_algorithm='md5', hash_type='contents'):
+        '''
+        Populate a dictionary with hash_value:filepath pairs for every file inside a zip or tar archive,
+        without extracting it. Member filepaths are reported as <archive_filepath>/<member_name>;
+        members with absolute or ".." names are skipped.
+
+        Zip members are hashed in parallel, since the format allows random access.
+        Tar archives are streamed once, front to back, since compressed tars do not.
+        '''
+        BLOCKSIZE = 65536
+        hashlist = {}
+        hashlist['headers'] = ['hash_value', 'filepath']
+        try:
+            if archive_filepath == None or not os.path.exists(archive_filepath):
+                raise IOError('[ERROR] Please provide a valid archive to hash.')
+
+            if self.verbose:
+                print('[{action_counter}] Hashing archive members of {archive_filepath}.\n'.format(action_counter=self.action_counter, archive_filepath=archive_filepath))
+
+            if zipfile.is_zipfile(archive_filepath):
+                # The central directory is parsed once and the open archive is shared by all workers:
+                with zipfile.ZipFile(archive_filepath) as archive:
+                    member_names = [info.filename for info in archive.infolist() if not info.is_dir()]
+                    member_names = [name for name in member_names if os.path.basename(name) not in PROTECTED_FILENAMES]
+                    for name in member_names:
+                        if not self.is_safe_member_name(member_name=name):
+                            print('[ERROR] Skipping unsafe archive member {name} in {archive_filepath}.'.format(name=name, archive_filepath=archive_filepath))
+                    member_names = [name for name in member_names if self.is_safe_member_name(member_name=name)]
+
+                    if hash_type == 'contents':
+                        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                            hash_values = executor.map(
+                                lambda name: self.hash_archive_member(archive=archive, member_name=name, hash_algorithm=hash_algorithm),
+                                member_names
+                            )
+                            for member_name, hash_value in zip(member_names, hash_values):
+                                hashlist[str(hash_value)] = self.add_archive_member(archive_filepath=archive_filepath, member_name=member_name)
+                                self.action_counter += 1
+                    elif hash_type == 'filenames':
+                        for member_name in member_names:
+                            hash_value = self.hash_filename(filename=os.path.basename(member_name), hash_algorithm=hash_algorithm)
+                            hashlist[str(hash_value)] = self.add_archive_member(archive_filepath=archive_filepath, member_name=member_name)
+                            self.action_counter += 1
+
+            elif tarfile.is_tarfile(archive_filepath):
+                # Stream mode ("r|*") reads the archive exactly once and never seeks backwards:
+                with tarfile.open(archive_filepath, mode='r|*') as archive:
+                    for member in archive:
+                        if not member.isfile() or os.path.basename(member.name) in PROTECTED_FILENAMES:
+                            continue
+                        if not self.is_safe_member_name(member_name=member.name):
+                            print('[ERROR] Skipping unsafe archive member {name} in {archive_filepath}.'.format(name=member.name, archive_filepath=archive_filepath))
+                            continue
+                        if hash_type == 'contents' and self.is_tree_hashed(size=member.size):
+                            hash_value = self.hash_stream_tree(inFile=archive.extractfile(member), hash_algorithm=hash_algorithm, chunk_size=self.tree_chunk_size)
+                        elif hash_type == 'contents':
+                            h = hashlib.new(hash_algorithm)
+                            inFile = archive.extractfile(member)
+                            buf = inFile.read(BLOCKSIZE)
+                            while len(buf) > 0:
+                                h.update(buf)
+                                buf = inFile.read(BLOCKSIZE)
+                            hash_value = h.hexdigest()
+                        elif hash_type == 'filenames':
+                            hash_value = self.hash_filename(filename=os.path.basename(member.name), hash_algorithm=hash_algorithm)
+                        hashlist[str(hash_value)] = self.add_archive_member(archive_filepath=archive_filepath, member_name=member.name)
+                        self.action_counter += 1
+            else:
+                raise IOError('[ERROR] {archive_filepath} is not a readable zip or tar archive.'.format(archive_filepath=archive_filepath))
+        except Exception as e:
+            print(e)
+
+        return hashlist
+
     def get_hashes(self, directory=None, hash_algorithm='md5', hash_type='contents'):
         '''
         Populate a dictionary with filename:hash_value pairs, given a directory and list of filenames.
@@ -136,9 +488,18 @@ class FilesInFolder:
             else:                               
                 filenames = self.find_filenames(directory=directory)
                 for filename in filenames:
-                    if filename not in PROTECTED_FILENAMES:
+                    if filename not in PROTECTED_FILENAMES and filename != CHUNKS_FILENAME:
                         filepath = os.path.join(directory, filename)
-                        if hash_type == 'contents':
+                        if self.hash_archives and self.is_archive(filepath=filepath):
+                            archive_hashlist = self.get_archive_hashes(archive_filepath=filepath, hash_algorithm=hash_algorithm, hash_type=hash_type)
+                            archive_hashlist.pop('headers')
+                            # An unreadable (or empty) archive is hashed as a whole file instead of vanishing:
+                            if archive_hashlist != {}:
+                                hashlist.update(archive_hashlist)
+                                continue
+                        if hash_type == 'contents' and self.is_tree_hashed(size=os.path.getsize(filepath)):
+                            hash_value = self.hash_file_tree(filepath=filepath, hash_algorithm=hash_algorithm, chunk_size=self.tree_chunk_size)
+                        elif hash_type == 'contents':
                             hash_value = self.hash_file_contents(filepath=filepath, hash_algorithm=hash_algorithm)
                         elif hash_type == 'filenames':
                             hash_value = self.hash_filename(filename=filename, hash_algorithm=hash_algorithm)
@@ -205,22 +566,370 @@ class FilesInFolder:
             print(e)
 
 
+    def get_block_signatures(self, filepath=None, block_size=DELTA_BLOCKSIZE, hash_algorithm='md5', byte_ranges=None):
+        '''
+        Returns a dictionary of offset:block_digest pairs for every block of the given file, or only for
+        the blocks inside the given (offset, length) byte ranges, using the given hashing algorithm.
+        '''
+        signatures = {}
+        try:
+            if filepath == None or not os.path.exists(filepath):
+                raise IOError('[ERROR] Please provide a valid filepath to sign.')
+            if byte_ranges == None:
+                byte_ranges = [(0, os.path.getsize(filepath))]
+            with open(filepath, 'rb') as inFile:
+                for range_offset, range_length in byte_ranges:
+                    range_end = range_offset + range_length
+                    offset = range_offset
+                    inFile.seek(offset)
+                    buf = inFile.read(min(block_size, range_end - offset))
+                    while len(buf) > 0:
+                        signatures[offset] = hashlib.new(hash_algorithm, buf).digest()
+                        offset += len(buf)
+                        buf = inFile.read(min(block_size, range_end - offset))
+        except Exception as e:
+            print(e)
+
+        return signatures
+
+    def delta_repair_file(self, source_filepath=None, destination_filepath=None, block_size=DELTA_BLOCKSIZE, hash_algorithm='md5'):
+        '''
+        Repairs the destination file in place so it matches the source file, rewriting only the blocks
+        whose digests differ, then verifies the final file hash. Falls back to a full copy if patching
+        fails part way or verification fails. Returns the number of blocks rewritten, or None if the
+        destination could not be repaired at all.
+
+        When both files were tree hashed with the same parameters, only the chunks whose digests differ
+        are read, patched and re-verified.
+        '''
+        blocks_written = 0
+        try:
+            if source_filepath == None or not os.path.exists(source_filepath):
+                raise IOError('[ERROR] Please provide a valid source filepath to repair from.')
+            if destination_filepath == None or not os.path.exists(destination_filepath):
+                raise IOError('[ERROR] Please provide a valid destination filepath to repair.')
+
+            source_size = os.path.getsize(source_filepath)
+            changed_chunks = self.compare_chunk_digests(left_filepath=source_filepath, right_filepath=destination_filepath)
+            if changed_chunks != None:
+                chunk_size = self.chunk_digests[str(source_filepath)]['chunk_size']
+                byte_ranges = [(index * chunk_size, chunk_size) for index in changed_chunks]
+            else:
+                byte_ranges = [(0, source_size)]
+
+            block_count = 0
+            try:
+                signatures = self.get_block_signatures(filepath=destination_filepath, block_size=block_size, hash_algorithm=hash_algorithm, byte_ranges=byte_ranges)
+                source_hash = hashlib.new(hash_algorithm)
+
+                with open(source_filepath, 'rb') as inFile, open(destination_filepath, 'r+b') as outFile:
+                    for range_offset, range_length in byte_ranges:
+                        range_end = range_offset + range_length
+                        offset = range_offset
+                        inFile.seek(offset)
+                        buf = inFile.read(min(block_size, range_end - offset))
+                        while len(buf) > 0:
+                            source_hash.update(buf)
+                            if hashlib.new(hash_algorithm, buf).digest() != signatures.get(offset):
+                                outFile.seek(offset)
+                                outFile.write(buf)
+                                blocks_written += 1
+                            block_count += 1
+                            offset += len(buf)
+                            buf = inFile.read(min(block_size, range_end - offset))
+                    outFile.truncate(source_size)
+
+                if changed_chunks != None:
+                    # The destination should now carry the source's chunk digests; re-check only the patched chunks:
+                    self.chunk_digests[str(destination_filepath)] = dict(self.chunk_digests[str(source_filepath)])
+                    verified = self.verify_file_chunks(filepath=destination_filepath, chunk_indices=changed_chunks) == []
+                else:
+                    verified = self.hash_file_contents(filepath=destination_filepath, hash_algorithm=hash_algorithm) == source_hash.hexdigest()
+            except Exception as e:
+                # Never leave the destination half patched:
+                print(e)
+                verified = False
+
+            if not verified:
+                print('[ERROR] Delta repair of {destination_filepath} failed, copying whole file.'.format(destination_filepath=destination_filepath))
+                self.chunk_digests.pop(str(destination_filepath), None)
+                shutil.copy2(source_filepath, destination_filepath)
+            else:
+                # Keep the same metadata a full copy2 would have given us:
+                shutil.copystat(source_filepath, destination_filepath)
+                if changed_chunks != None:
+                    destination_stat = os.stat(destination_filepath)
+                    self.chunk_digests[str(destination_filepath)]['size'] = destination_stat.st_size
+                    self.chunk_digests[str(destination_filepath)]['mtime_ns'] = destination_stat.st_mtime_ns
+
+            if self.verbose:
+                print('[{action_counter}] Rewrote {blocks_written} of {block_count} blocks in {destination_filepath}.\n'.format(
+                                                                                                                        action_counter=self.action_counter,
+                                                                                                                        blocks_written=blocks_written,
+                                                                                                                        block_count=block_count,
+                                                                                                                        destination_filepath=destination_filepath
+                                                                                                                    ))
+        except Exception as e:
+            print(e)
+            blocks_written = None
+
+        return blocks_written
+
+    def split_archive_member_path(self, filepath=None):
+        '''
+        Splits an archive member path, as reported by get_archive_hashes, into (archive_filepath, member_name).
+        Paths hashed in this run are looked up as recorded; others (e.g. read back from missing.txt) are split
+        at the first "/" whose prefix is an archive file. Returns (None, None) for ordinary filepaths.
+        '''
+        if filepath in self.archive_members:
+            return self.archive_members[filepath]
+
+        separator_index = filepath.find('/')
+        while separator_index != -1:
+            archive_filepath = filepath[:separator_index]
+            if archive_filepath != '' and self.is_archive(filepath=archive_filepath) and os.path.isfile(archive_filepath):
+                member_name = filepath[separator_index + 1:]
+                if not self.is_safe_member_name(member_name=member_name):
+                    raise IOError('[ERROR] Refusing unsafe archive member {member_name} in {archive_filepath}.'.format(member_name=member_name, archive_filepath=archive_filepath))
+                return archive_filepath, member_name
+            separator_index = filepath.find('/', separator_index + 1)
+        return None, None
+
+    def write_stream_atomically(self, inFile=None, destination_filepath=None, mtime=None):
+        '''
+        Writes a readable stream to the destination through a temporary ".part" file that is renamed into
+        place once complete, then applies the given modification time.
+        '''
+        partial_filepath = os.path.join(os.path.dirname(destination_filepath), '.' + os.path.basename(destination_filepath) + '.part')
+        try:
+            with open(partial_filepath, 'wb') as outFile:
+                shutil.copyfileobj(inFile, outFile)
+            if mtime != None:
+                os.utime(partial_filepath, (mtime, mtime))
+            os.replace(partial_filepath, destination_filepath)
+        except Exception:
+            if os.path.exists(partial_filepath):
+                os.remove(partial_filepath)
+            raise
+        return destination_filepath
+
+    def extract_archive_members(self, archive_filepath=None, member_destinations={}):
+        '''
+        Writes the given zip or tar archive members (a dictionary of member_name:destination_filepath) without
+        extracting the rest of the archive, keeping each member's modification time.
+        Tar archives are streamed once, front to back, however many members are wanted from them.
+        Returns the list of destination filepaths written.
+        '''
+        written_filepaths = []
+        if zipfile.is_zipfile(archive_filepath):
+            with zipfile.ZipFile(archive_filepath) as archive:
+                for member_name, destination_filepath in member_destinations.items():
+                    try:
+                        info = archive.getinfo(member_name)
+                        with archive.open(info) as inFile:
+                            self.write_stream_atomically(inFile=inFile, destination_filepath=destination_filepath, mtime=time.mktime(info.date_time + (0, 0, -1)))
+                        written_filepaths.append(destination_filepath)
+                    except Exception as e:
+                        print(e)
+        else:
+            remaining_members = set(member_destinations)
+            with tarfile.open(archive_filepath, mode='r|*') as archive:
+                for member in archive:
+                    if not member.isfile() or member.name not in member_destinations:
+                        continue
+                    try:
+                        self.write_stream_atomically(inFile=archive.extractfile(member), destination_filepath=member_destinations[member.name], mtime=member.mtime)
+                        written_filepaths.append(member_destinations[member.name])
+                        remaining_members.discard(member.name)
+                    except Exception as e:
+                        print(e)
+            for member_name in remaining_members:
+                print('[ERROR] {member_name} was not extracted from {archive_filepath}.'.format(member_name=member_name, archive_filepath=archive_filepath))
+
+        return written_filepaths
+
     def write_missing_files(self, missing_filepaths=[], destination_directory=None):
         '''
-        Writes missing files to the destination filepath.
+        Writes missing files to the destination filepath and returns how many were written.
+        With repair_mode='delta', files that already exist under the same name are repaired in place.
+        Archive members (from hash_archives=True) are extracted into the destination, one pass per archive.
         '''
+        repaired_count = 0
+        archive_member_destinations = {} # archive_filepath: {member_name: destination_filepath}
         try:
             if missing_filepaths == []:
                 raise Exception('[ERROR] Need to provide a valid list of missing files.')
             else:
                 for missing_filepath in missing_filepaths:
-                    missing_filename = os.path.basename(missing_filepath)
-                    # Use copy2 to retain metadata such as creation and modification times of the file
-                    destination_filepath = os.path.join(destination_directory, missing_filename)
-                    shutil.copy2(missing_filepath, destination_filepath)
+                    # One failed file should not stop the rest from being repaired:
+                    try:
+                        missing_filename = os.path.basename(missing_filepath)
+                        destination_filepath = os.path.join(destination_directory, missing_filename)
+                        archive_filepath, member_name = self.split_archive_member_path(filepath=missing_filepath)
+                        if archive_filepath != None:
+                            archive_member_destinations.setdefault(archive_filepath, {})[member_name] = destination_filepath
+                            continue
+                        elif self.repair_mode == 'delta' and os.path.isfile(destination_filepath):
+                            if self.delta_repair_file(source_filepath=missing_filepath, destination_filepath=destination_filepath, hash_algorithm=self.hash_algorithm) == None:
+                                continue
+                        else:
+                            # Use copy2 to retain metadata such as creation and modification times of the file
+                            shutil.copy2(missing_filepath, destination_filepath)
+                        repaired_count += 1
+                    except Exception as e:
+                        print(e)
+
+                for archive_filepath, member_destinations in archive_member_destinations.items():
+                    try:
+                        repaired_count += len(self.extract_archive_members(archive_filepath=archive_filepath, member_destinations=member_destinations))
+                    except Exception as e:
+                        print(e)
         except Exception as e:
             print(e)
 
+        return repaired_count
+
+
+    def iter_list_filepaths(self, list_filepath=None, filename_column='filename'):
+        '''
+        Streams filepaths, one row at a time, from a missing files list: either a plain text file with
+        one filepath per line (like missing.txt) or a CSV with a filename column (falling back to "filepath").
+        '''
+        with open(list_filepath, 'r', newline='') as infile:
+            if list_filepath.lower().endswith('.csv'):
+                reader = csv.reader(infile)
+                headers = next(reader, [])
+                if filename_column in headers:
+                    column = headers.index(filename_column)
+                elif 'filepath' in headers:
+                    column = headers.index('filepath')
+                else:
+                    raise Exception('[ERROR] {list_filepath} has no "{filename_column}" column.'.format(list_filepath=list_filepath, filename_column=filename_column))
+                for row in reader:
+                    if len(row) > column and row[column] != '':
+                        yield row[column]
+            else:
+                # Only the line ending is dropped, so names with leading or trailing spaces round-trip exactly:
+                for line in infile:
+                    filepath = line.rstrip('\r\n')
+                    if filepath != '':
+                        yield filepath
+
+    def copy_file_atomically(self, source_filepath=None, destination_filepath=None):
+        '''
+        Copies a file through a temporary ".part" file that is renamed into place once complete,
+        so an interrupted copy never leaves a truncated file under the real name.
+        '''
+        partial_filepath = os.path.join(os.path.dirname(destination_filepath), '.' + os.path.basename(destination_filepath) + '.part')
+        try:
+            # Use copy2 to retain metadata such as creation and modification times of the file
+            shutil.copy2(source_filepath, partial_filepath)
+            os.replace(partial_filepath, destination_filepath)
+        except Exception:
+            # Don't leave the partial copy behind to be hashed as a user file later:
+            if os.path.exists(partial_filepath):
+                os.remove(partial_filepath)
+            raise
+        return destination_filepath
+
+    def repair_from_list(self, list_filepath=None, destination_directory=None, source_directory=None, filename_column='filename'):
+        '''
+        Copies every file named in a missing files list (missing.txt or a CSV) into the destination directory.
+
+        - The list is streamed row by row, so memory does not grow with its size.
+        - Each directory is listed once with scandir instead of checking every file with os.path.exists.
+        - Copies run on a bounded thread pool and are renamed into place only once complete.
+        - Files already present in the destination are skipped, so an interrupted run can simply be rerun.
+
+        Bare filenames are looked up in source_directory; entries with a directory part are used as given.
+        Archive members (<archive_filepath>/<member_name>, as written with hash_archives=True) are extracted
+        with extract_archive_members, one pass per archive once the list has been read.
+        Returns the number of files copied.
+        '''
+        copied_count = 0
+        directory_listings = {}
+        archive_member_destinations = {} # archive_filepath: {member_name: destination_filepath}
+
+        def list_directory(directory):
+            # One scandir per directory, cached for the rest of the run:
+            if directory not in directory_listings:
+                try:
+                    with os.scandir(directory) as entries:
+                        directory_listings[directory] = {entry.name for entry in entries if entry.is_file()}
+                except OSError:
+                    directory_listings[directory] = set()
+            return directory_listings[directory]
+
+        try:
+            if list_filepath == None or not os.path.exists(list_filepath):
+                raise IOError('[ERROR] Please provide a valid missing files list.')
+            if destination_directory == None or not os.path.exists(destination_directory):
+                raise IOError('[ERROR] Please provide a valid destination directory.')
+
+            if self.verbose:
+                print('[{action_counter}] Repairing {destination_directory} from {list_filepath}.\n'.format(action_counter=self.action_counter, destination_directory=destination_directory, list_filepath=list_filepath))
+
+            max_workers = self.max_workers or min(32, (os.cpu_count() or 1) + 4)
+            destination_filenames = list_directory(destination_directory)
+            scheduled_filenames = set()
+            pending = set()
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for filepath in self.iter_list_filepaths(list_filepath=list_filepath, filename_column=filename_column):
+                    if os.path.dirname(filepath) == '' and source_directory != None:
+                        filepath = os.path.join(source_directory, filepath)
+                    filename = os.path.basename(filepath)
+
+                    if filename in destination_filenames or filename in scheduled_filenames:
+                        continue
+                    try:
+                        archive_filepath, member_name = self.split_archive_member_path(filepath=filepath)
+                    except Exception as e:
+                        print(e)
+                        continue
+                    if archive_filepath != None:
+                        scheduled_filenames.add(filename)
+                        archive_member_destinations.setdefault(archive_filepath, {})[member_name] = os.path.join(destination_directory, filename)
+                        continue
+                    if filename not in list_directory(os.path.dirname(filepath) or '.'):
+                        print('[ERROR] {filepath} does not exist.'.format(filepath=filepath))
+                        continue
+
+                    scheduled_filenames.add(filename)
+                    # Keep only a bounded number of copies in flight, so the list is never read ahead into memory:
+                    if len(pending) >= 2 * max_workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        copied_count += self.report_copies(done=done)
+                    pending.add(executor.submit(self.copy_file_atomically, filepath, os.path.join(destination_directory, filename)))
+
+                for archive_filepath, member_destinations in archive_member_destinations.items():
+                    pending.add(executor.submit(self.extract_archive_members, archive_filepath, member_destinations))
+
+                copied_count += self.report_copies(done=wait(pending).done)
+
+            self.action_counter += 1
+        except Exception as e:
+            print(e)
+
+        return copied_count
+
+    def report_copies(self, done=()):
+        '''
+        Reports on a batch of finished copy futures and returns how many files they copied.
+        A future holds either one destination filepath or, for archive extractions, a list of them.
+        '''
+        copied_count = 0
+        for future in done:
+            try:
+                result = future.result()
+                destination_filepaths = result if isinstance(result, list) else [result]
+                copied_count += len(destination_filepaths)
+                if self.verbose:
+                    for destination_filepath in destination_filepaths:
+                        print('[{action_counter}] Copied {destination_filepath}.\n'.format(action_counter=self.action_counter, destination_filepath=destination_filepath))
+            except Exception as e:
+                print(e)
+        return copied_count
 
     def cleanup(self):
         '''
@@ -244,15 +953,32 @@ class FilesInFolder:
                 self.action_counter += 1
                 
 
-    def run(self):
+    def run(self, fix_missing_files=None):
         '''
         Runs all the required functions to check whether two folders have identical content.
+        After repairing missing files it re-runs once to check the result, without repairing again.
         '''
+        if fix_missing_files == None:
+            fix_missing_files = self.fix_missing_files
+
+        if self.tree_hash_threshold != None:
+            # Chunk digests from an earlier run save re-reading unchanged large files:
+            for folder in (self.left_folder, self.right_folder):
+                chunks_filepath = os.path.join(folder, CHUNKS_FILENAME)
+                if os.path.exists(chunks_filepath):
+                    self.load_chunk_digests(chunks_filepath=chunks_filepath)
+
         left_hash_dict = self.get_hashes(directory=self.left_folder, hash_algorithm=self.hash_algorithm, hash_type=self.hash_type)
         right_hash_dict = self.get_hashes(directory=self.right_folder, hash_algorithm=self.hash_algorithm, hash_type=self.hash_type)
         
         missing_hash_value_filepaths = self.compare_hash_lists(left_hash_dict=left_hash_dict, right_hash_dict=right_hash_dict)
 
+        if self.write_mode != None and self.chunk_digests != {}:
+            # Keep chunk digests of tree-hashed files for later partial verification:
+            self.write_chunk_digests(directory=self.left_folder, chunks_filepath=os.path.join(self.left_folder, CHUNKS_FILENAME))
+            self.write_chunk_digests(directory=self.right_folder, chunks_filepath=os.path.join(self.right_folder, CHUNKS_FILENAME))
+            self.action_counter += 1
+
         if self.write_mode != None:
             # Missing files:
             if len(missing_hash_value_filepaths) == 0:
@@ -277,27 +1003,28 @@ class FilesInFolder:
 
                 self.action_counter += 1 
             else:   
-                missing_files_filepath = os.path.join(self.left_folder, missing_files_filename)
+                missing_files_filepath = os.path.join(self.left_folder, self.missing_files_filename)
                 if self.verbose:
                     print('[{action_counter}] Writing missing file info to {missing_files_filepath}.\n'.format(action_counter=self.action_counter, missing_files_filepath=missing_files_filepath))
                 self.write_list_contents(list_contents=missing_hash_value_filepaths, missing_files_filepath=missing_files_filepath)
                 self.action_counter += 1
 
-                if self.fix_missing_files:
+                if fix_missing_files:
                     if self.verbose:
                         print(f'[{self.action_counter}] Writing missing files to {self.right_folder}.\n')
-                    self.write_missing_files(missing_filepaths=missing_hash_value_filepaths, destination_directory=self.right_folder)
+                    repaired_count = self.write_missing_files(missing_filepaths=missing_hash_value_filepaths, destination_directory=self.right_folder)
                     self.action_counter += 1
 
+                    # Nothing was repaired, so re-running would only find the same missing files:
+                    if repaired_count > 0:
+                        if self.verbose:
+                            print(f'[{self.action_counter}] Cleaning up metadata files.\n')
+                        self.cleanup()
 
-                    if self.verbose:
-                        print(f'[{self.action_counter}] Cleaning up metadata files.\n')
-                    self.cleanup()
-                    
-                    if self.verbose:
-                        print(f'[{self.action_counter}] Rerunning file checker.\n')
-                    self.action_counter += 1
-                    self.run()
+                        if self.verbose:
+                            print(f'[{self.action_counter}] Rerunning file checker.\n')
+                        self.action_counter += 1
+                        self.run(fix_missing_files=False)
 
 
                        
@@ -317,6 +1044,10 @@ if __name__ == '__main__':
     contents_filename = 'contents.csv'
     missing_files_filename = 'missing.txt'
     fix_missing_files = True
+    hash_archives = False # Hash the files inside .zip/.tar archives instead of the archives themselves
+    max_workers = None # Number of threads used for parallel hashing (None lets Python decide)
+    repair_mode = 'copy' # Other option is "delta" (rewrite only changed blocks of same-named files)
+    tree_hash_threshold = None # Files at least this many bytes are tree hashed in parallel chunks (None disables)
 
     file_checker = FilesInFolder(
                                     left_folder=left_folder,
@@ -327,6 +1058,10 @@ if __name__ == '__main__':
                                     contents_filename=contents_filename,
                                     missing_files_filename=missing_files_filename,
                                     fix_missing_files=fix_missing_files,
+                                    hash_archives=hash_archives,
+                                    max_workers=max_workers,
+                                    repair_mode=repair_mode,
+                                    tree_hash_threshold=tree_hash_threshold,
                                     verbose=True
                                 )
 
@@ -337,6 +1072,9 @@ if __name__ == '__main__':
 
     #hashlist = file_checker.get_hashes(directory=left_folder, hash_algorithm=hash_algorithm, hash_type=hash_type)
 
+    # Repair the right folder from a previously written missing files list (missing.txt or a CSV):
+    #file_checker.repair_from_list(list_filepath=os.path.join(left_folder, missing_files_filename), destination_directory=right_folder, source_directory=left_folder)
+
     #contents_filepath = os.path.join(left_folder, contents_filename)
     #file_checker.write_dictionary_contents(dictionary_contents=hashlist, write_mode=write_mode, contents_filepath=contents_filepath)
     file_checker.run()
\ No newline at end of file